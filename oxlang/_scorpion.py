@@ -5,14 +5,20 @@
 
 from __future__ import annotations
 
-import collections
+import array
 import enum
 from dataclasses import dataclass
-from typing import List, Union
+from typing import Dict, List, Tuple, Union
+
+from .exceptions import VMError
 
 
 Primitive = Union[bytes, int, float, bool]
 
+# value of registers that have not been stored to (or were cleared).
+# None can't be used for this, as it could be a real value.
+UNSET = object()
+
 
 class Opcode(enum.Enum):
     PUSH_CONST = 0
@@ -31,7 +37,7 @@ class Opcode(enum.Enum):
     CMPLE = 13
     CMPLT = 14
     GOTO = 15
-    REG_STORE = 15
+    REG_STORE = 16
     REG_UPDATE = 17
     REG_CLEAR = 18
     REG_LOAD = 19
@@ -47,82 +53,358 @@ class Opcode(enum.Enum):
     PVIRT_H = 29
     VIRT_E = 30
     P_VIRT_E = 31
+    # superinstructions (not part of Scorpion).
+    # These fuse a PUSH_CONST with the instruction after it.
+    PUSH_ADD = 32
+    PUSH_SUB = 33
+    PUSH_MUL = 34
+    PUSH_PUSH = 35
+    # These fuse a REG_LOAD with the binary instruction after it,
+    # and optionally the PUSH_CONST before it (i.e x + 1).
+    LOAD_ADD = 36
+    LOAD_SUB = 37
+    LOAD_MUL = 38
+    LOAD_ADD_CONST = 39
+    LOAD_SUB_CONST = 40
+    LOAD_MUL_CONST = 41
+
+
+JUMPS = {Opcode.GOTO.value, Opcode.IF_TRUE.value, Opcode.IF_FALSE.value}
+
+# binary instructions that can be fused with a PUSH_CONST before them.
+FUSED = {
+    Opcode.ADD.value: Opcode.PUSH_ADD,
+    Opcode.SUB.value: Opcode.PUSH_SUB,
+    Opcode.MUL.value: Opcode.PUSH_MUL,
+}
+
+# binary instructions that can be fused with a REG_LOAD before them.
+FUSED_LOAD = {
+    Opcode.ADD.value: Opcode.LOAD_ADD,
+    Opcode.SUB.value: Opcode.LOAD_SUB,
+    Opcode.MUL.value: Opcode.LOAD_MUL,
+}
+
+# binary instructions that can be fused with a PUSH_CONST and REG_LOAD before them.
+FUSED_LOAD_CONST = {
+    Opcode.ADD.value: Opcode.LOAD_ADD_CONST,
+    Opcode.SUB.value: Opcode.LOAD_SUB_CONST,
+    Opcode.MUL.value: Opcode.LOAD_MUL_CONST,
+}
 
 
 @dataclass
 class Instruction:
+    __slots__ = ("opcode", "args")
+
     opcode: Opcode
     args: List[Primitive]
 
 
+class Program:
+    """A sequence of instructions, stored as parallel arrays of opcodes and args.
+
+    The opcode of instruction n is ops[n], and its args are args[n].
+    """
+
+    def __init__(self):
+        self.ops = array.array("B")
+        self.args: List[Tuple[Primitive, ...]] = []
+        # variable name -> register number
+        self.registers: Dict[str, int] = {}
+        # indexes of the 'continue' and 'break' jumps in each loop being emitted,
+        # to be patched once the loop's bytecode is complete.
+        self.loops: List[Tuple[List[int], List[int]]] = []
+
+    def __len__(self):
+        return len(self.ops)
+
+    def append(self, opcode: Opcode, *args: Primitive):
+        self.ops.append(opcode.value)
+        self.args.append(args)
+
+    def extend(self, instructions: List[Instruction]):
+        for ins in instructions:
+            self.append(ins.opcode, *ins.args)
+
+    def jump(self, opcode: Opcode) -> int:
+        """Append a jump with no target yet, returning its index so it can be patched later."""
+
+        self.append(opcode, -1)
+        return len(self.ops) - 1
+
+    def patch(self, index: int, target: int):
+        """Set the target of the jump at index."""
+
+        self.args[index] = (target,)
+
+    def register(self, name: str) -> int:
+        """Get the register number of a variable, allocating one if it does not exist yet."""
+
+        try:
+            return self.registers[name]
+        except KeyError:
+            reg = self.registers[name] = len(self.registers)
+            return reg
+
+    def optimize(self) -> Program:
+        """Return a copy of this program with superinstructions substituted in.
+
+        Jump targets are remapped to the new instruction indexes.
+        An instruction that is the target of a jump is never fused into the one before it.
+        """
+
+        ops = self.ops
+        args = self.args
+        n = len(ops)
+
+        push_const = Opcode.PUSH_CONST.value
+        reg_load = Opcode.REG_LOAD.value
+        targets = {args[i][0] for i in range(n) if ops[i] in JUMPS}
+
+        program = Program()
+        program.registers = self.registers.copy()
+        # old instruction index -> new instruction index
+        index = {}
+
+        i = 0
+        while i < n:
+            index[i] = len(program)
+            op = ops[i]
+
+            # PUSH_CONST REG_LOAD <binop> becomes LOAD_<binop>_CONST.
+            if (
+                op == push_const
+                and i + 2 < n
+                and ops[i + 1] == reg_load
+                and ops[i + 2] in FUSED_LOAD_CONST
+                and i + 1 not in targets
+                and i + 2 not in targets
+            ):
+                program.append(FUSED_LOAD_CONST[ops[i + 2]], *args[i + 1], *args[i])
+                i += 3
+                continue
+
+            if op == reg_load and i + 1 < n and i + 1 not in targets:
+                if ops[i + 1] in FUSED_LOAD:
+                    program.append(FUSED_LOAD[ops[i + 1]], *args[i])
+                    i += 2
+                    continue
+
+            if op == push_const and i + 1 < n and i + 1 not in targets:
+                next_op = ops[i + 1]
+
+                if next_op in FUSED:
+                    program.append(FUSED[next_op], *args[i])
+                    i += 2
+                    continue
+
+                # PUSH_CONST PUSH_CONST <binop> is better off as PUSH_CONST PUSH_<binop>.
+                if next_op == push_const and not (
+                    i + 2 < n and ops[i + 2] in FUSED and i + 2 not in targets
+                ):
+                    program.append(Opcode.PUSH_PUSH, *args[i], *args[i + 1])
+                    i += 2
+                    continue
+
+            program.ops.append(op)
+            program.args.append(args[i])
+            i += 1
+
+        # jumping past the last instruction ends the program.
+        index[n] = len(program)
+
+        for i, op in enumerate(program.ops):
+            if op in JUMPS:
+                target, *rest = program.args[i]
+                program.args[i] = (index[target], *rest)
+
+        return program
+
+
 class Runtime:
     def __init__(self):
-        self.stack = collections.deque()
+        self.stack: List[Primitive] = []
+        # register values, indexed by register number.
+        self.registers: List[Primitive] = []
+        # index of the next instruction to run. Jumps change this directly.
+        self.pc = 0
+
+        # opcode handlers are looked up once here, instead of on every instruction.
+        self._dispatch = [None] * (max(op.value for op in Opcode) + 1)
+        # opcodes without a handler: programs using them are rejected before they run.
+        self._unsupported = set()
+
+        for op in Opcode:
+            handler = getattr(self, f"ins_{op.name.lower()}", None)
+            if handler is None:
+                self._unsupported.add(op.value)
+
+            self._dispatch[op.value] = handler
+
+    def run(self, program: Program):
+        if not self._unsupported.isdisjoint(program.ops):
+            names = sorted(
+                {Opcode(op).name for op in program.ops if op in self._unsupported}
+            )
+            raise VMError(f"opcodes not supported by the VM: {', '.join(names)}")
+
+        # make room for any registers the program uses.
+        missing = len(program.registers) - len(self.registers)
+        if missing > 0:
+            self.registers.extend([UNSET] * missing)
+
+        # handlers get the stack's methods as arguments, so they don't have to look them up.
+        push = self.stack.append
+        pop = self.stack.pop
+
+        dispatch = self._dispatch
+        ops = program.ops
+        args = program.args
+        n = len(ops)
+
+        self.pc = 0
+
+        while self.pc < n:
+            pc = self.pc
+            self.pc += 1
+
+            dispatch[ops[pc]](push, pop, *args[pc])
+
+    def _load(self, reg: int) -> Primitive:
+        value = self.registers[reg]
+        if value is UNSET:
+            raise NameError(f"register {reg} is loaded before it is set")
+
+        return value
+
+    def ins_push_const(self, push, pop, value: Primitive):
+        push(value)
+
+    def ins_add(self, push, pop):
+        value1 = pop()
+        value2 = pop()
+
+        push(value1 + value2)
+
+    def ins_sub(self, push, pop):
+        value1 = pop()
+        value2 = pop()
+
+        push(value1 - value2)
+
+    def ins_mul(self, push, pop):
+        value1 = pop()
+        value2 = pop()
+
+        push(value1 * value2)
+
+    def ins_div(self, push, pop):
+        value1 = pop()
+        value2 = pop()
+
+        push(value1 / value2)
+
+    def ins_pow(self, push, pop):
+        value1 = pop()
+        value2 = pop()
+
+        push(value1 ** value2)
+
+    def ins_and(self, push, pop):
+        value1 = pop()
+        value2 = pop()
+
+        push(bool(value1 and value2))
+
+    def ins_or(self, push, pop):
+        value1 = pop()
+        value2 = pop()
+
+        push(bool(value1 or value2))
+
+    def ins_not(self, push, pop):
+        value = pop()
+
+        push(bool(not value))
+
+    def ins_eq(self, push, pop):
+        value1 = pop()
+        value2 = pop()
+
+        push(value1 == value2)
+
+    def ins_neq(self, push, pop):
+        value1 = pop()
+        value2 = pop()
 
-    def execute(self, ins: Instruction):
-        opcode_name = ins.opcode.name
-        opcode_func = getattr(self, f"ins_{opcode_name.lower()}")
+        push(value1 != value2)
 
-        opcode_func(*ins.args)
+    def ins_cmple(self, push, pop):
+        value1 = pop()
+        value2 = pop()
 
-    def ins_push_const(self, value: Primitive):
-        self.stack.append(value)
+        push(value1 <= value2)
 
-    def ins_add(self):
-        value1 = self.stack.pop()
-        value2 = self.stack.pop()
+    def ins_cmplt(self, push, pop):
+        value1 = pop()
+        value2 = pop()
 
-        self.stack.append(value1 + value2)
+        push(value1 < value2)
 
-    def ins_sub(self):
-        value1 = self.stack.pop()
-        value2 = self.stack.pop()
+    def ins_reg_store(self, push, pop, reg: int):
+        self.registers[reg] = pop()
 
-        self.stack.append(value1 - value2)
+    def ins_reg_update(self, push, pop, reg: int):
+        self.registers[reg] = pop()
 
-    def ins_mul(self):
-        value1 = self.stack.pop()
-        value2 = self.stack.pop()
+    def ins_reg_clear(self, push, pop, reg: int):
+        self.registers[reg] = UNSET
 
-        self.stack.append(value1 * value2)
+    def ins_reg_load(self, push, pop, reg: int):
+        push(self._load(reg))
 
-    def ins_div(self):
-        value1 = self.stack.pop()
-        value2 = self.stack.pop()
+    def ins_pop(self, push, pop):
+        pop()
 
-        self.stack.append(value1 / value2)
+    def ins_push_add(self, push, pop, value: Primitive):
+        push(value + pop())
 
-    def ins_pow(self):
-        value1 = self.stack.pop()
-        value2 = self.stack.pop()
+    def ins_push_sub(self, push, pop, value: Primitive):
+        push(value - pop())
 
-        self.stack.append(value1 ** value2)
+    def ins_push_mul(self, push, pop, value: Primitive):
+        push(value * pop())
 
-    def ins_and(self):
-        value1 = self.stack.pop()
-        value2 = self.stack.pop()
+    def ins_push_push(self, push, pop, value1: Primitive, value2: Primitive):
+        push(value1)
+        push(value2)
 
-        self.stack.append(bool(value1 and value2))
+    def ins_load_add(self, push, pop, reg: int):
+        push(self._load(reg) + pop())
 
-    def ins_or(self):
-        value1 = self.stack.pop()
-        value2 = self.stack.pop()
+    def ins_load_sub(self, push, pop, reg: int):
+        push(self._load(reg) - pop())
 
-        self.stack.append(bool(value1 or value2))
+    def ins_load_mul(self, push, pop, reg: int):
+        push(self._load(reg) * pop())
 
-    def ins_not(self):
-        value = self.stack.pop()
+    def ins_load_add_const(self, push, pop, reg: int, value: Primitive):
+        push(self._load(reg) + value)
 
-        self.stack.append(bool(not value))
+    def ins_load_sub_const(self, push, pop, reg: int, value: Primitive):
+        push(self._load(reg) - value)
 
-    def ins_eq(self):
-        value1 = self.stack.pop()
-        value2 = self.stack.pop()
+    def ins_load_mul_const(self, push, pop, reg: int, value: Primitive):
+        push(self._load(reg) * value)
 
-        self.stack.append(value1 == value2)
+    def ins_if_true(self, push, pop, target: int):
+        if pop():
+            self.pc = target
 
-    def ins_neq(self):
-        value1 = self.stack.pop()
-        value2 = self.stack.pop()
+    def ins_if_false(self, push, pop, target: int):
+        if not pop():
+            self.pc = target
 
-        self.stack.append(value1 != value2)
+    def ins_goto(self, push, pop, target: int):
+        self.pc = target
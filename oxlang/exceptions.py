@@ -7,3 +7,11 @@ class OxError(Exception):
 
 class ParserError(OxError):
     pass
+
+
+class CompileError(OxError):
+    pass
+
+
+class VMError(OxError):
+    pass
@@ -4,10 +4,17 @@
 from __future__ import annotations
 
 import ast
-import textwrap
-from dataclasses import dataclass
+import operator
+from dataclasses import dataclass, field, fields
 from typing import Any, Dict, List, Optional, Union
 
+from ._scorpion import Opcode, Program
+from .exceptions import CompileError
+
+
+# Expression contexts carry no state, so a single instance of each is shared.
+LOAD = ast.Load()
+STORE = ast.Store()
 
 BINOP = {
     "+": ast.Add(),
@@ -18,10 +25,28 @@ BINOP = {
 }
 
 UNOP = {
-    "-": ast.Invert(),
+    "-": ast.USub(),
     "!": ast.Not(),
 }
 
+# Used to fold operations on constants at compile time.
+BINOP_FN = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": operator.truediv,
+    "^": operator.pow,
+}
+
+UNOP_FN = {
+    "-": operator.neg,
+    "!": operator.not_,
+}
+
+# Like CPython's constant folding, integer results larger than this (in bits) are left to runtime,
+# so code such as 7 ^ 3000000 doesn't stall the parser.
+MAX_FOLD_BITS = 128
+
 COMPARE = {
     "==": ast.Eq(),
     "!=": ast.NotEq(),
@@ -33,7 +58,73 @@ COMPARE = {
     "||": ast.Or(),
 }
 
+# Scorpion opcodes for each binary operator.
+# Operands are pushed right first, so the left operand is at the top of the stack.
+# A True value means the operands are pushed in reverse (i.e a > b is b < a).
+OPCODES = {
+    "+": (Opcode.ADD, False),
+    "-": (Opcode.SUB, False),
+    "*": (Opcode.MUL, False),
+    "/": (Opcode.DIV, False),
+    "^": (Opcode.POW, False),
+    "==": (Opcode.EQ, False),
+    "!=": (Opcode.NEQ, False),
+    "<": (Opcode.CMPLT, False),
+    "<=": (Opcode.CMPLE, False),
+    ">": (Opcode.CMPLT, True),
+    ">=": (Opcode.CMPLE, True),
+    "&&": (Opcode.AND, False),
+    "||": (Opcode.OR, False),
+}
 
+# Python AST node types that must be wrapped in an ast.Expr when used as a statement.
+EXPRESSIONS = frozenset(
+    {
+        ast.Attribute,
+        ast.BinOp,
+        ast.Call,
+        ast.Compare,
+        ast.Constant,
+        ast.List,
+        ast.Name,
+        ast.Subscript,
+        ast.UnaryOp,
+    }
+)
+
+
+def slots(cls):
+    """Recreate a dataclass with __slots__ for its fields, so its instances don't need a __dict__.
+    (dataclass(slots=True) does the same thing, but only on Python 3.10 and up.)
+    """
+
+    inherited = {name for base in cls.__mro__[1:] for name in getattr(base, "__slots__", ())}
+    names = tuple(f.name for f in fields(cls) if f.name not in inherited)
+
+    namespace = dict(cls.__dict__)
+    namespace["__slots__"] = names
+
+    # Field defaults can't be class attributes with the same name as a slot.
+    # (__init__ keeps its own reference to them anyway.)
+    for name in ("__dict__", "__weakref__", *names):
+        namespace.pop(name, None)
+
+    new_cls = type(cls)(cls.__name__, cls.__bases__, namespace)
+
+    # methods using super() refer to the class they were defined in, so point them to the new class.
+    for value in namespace.values():
+        for cell in getattr(value, "__closure__", None) or ():
+            try:
+                if cell.cell_contents is cls:
+                    cell.cell_contents = new_cls
+            except ValueError:
+                # empty cell
+                pass
+
+    return new_cls
+
+
+@slots
 @dataclass
 class Node:
     lineno: int
@@ -42,15 +133,14 @@ class Node:
     def compile(self) -> Optional[ast.AST]:
         pass
 
-
-@dataclass
-class Comment(Node):
-    text: str
-
-    def compile(self):
-        return
+    def emit(self, program: Program):
+        # Append this node's Scorpion bytecode to the program.
+        raise CompileError(
+            f"line {self.lineno}: {type(self).__name__} cannot be compiled to Scorpion bytecode (yet)"
+        )
 
 
+@slots
 @dataclass
 class Constant(Node):
     # A hardcoded value in the code.
@@ -59,7 +149,11 @@ class Constant(Node):
     def compile(self):
         return ast.Constant(value=self.value)
 
+    def emit(self, program):
+        program.append(Opcode.PUSH_CONST, self.value)
+
 
+@slots
 @dataclass
 class Variable(Node):
     # A variable in the current or global namespace.
@@ -70,16 +164,24 @@ class Variable(Node):
         return ".".join([self.name, *self.attrs])
 
     def compile(self):
-        attrs = self.name.split(".")
+        # the parser has already split the dotted name into name and attrs.
         # default behaviour is to load: this can be changed by other nodes.
-        var = ast.Name(id=attrs[0], ctx=ast.Load())
+        var = ast.Name(id=self.name, ctx=LOAD)
 
-        for attr in attrs[1:]:
-            var = ast.Attribute(value=var, attr=attr, ctx=ast.Load())
+        for attr in self.attrs:
+            var = ast.Attribute(value=var, attr=attr, ctx=LOAD)
 
         return var
 
+    def emit(self, program):
+        if self.attrs:
+            # struct members are not supported by the VM.
+            super().emit(program)
+
+        program.append(Opcode.REG_LOAD, program.register(self.name))
 
+
+@slots
 @dataclass
 class Assign(Node):
     var: Variable
@@ -87,11 +189,21 @@ class Assign(Node):
 
     def compile(self):
         target = self.var.compile()
-        target.ctx = ast.Store()
+        target.ctx = STORE
 
+        # var = var + expr is not rewritten to var += expr:
+        # for mutable values (i.e lists) += changes the value in place, which other references would see.
         return ast.Assign(targets=[target], value=self.value.compile())
 
+    def emit(self, program):
+        if self.var.attrs:
+            super().emit(program)
+
+        self.value.emit(program)
+        program.append(Opcode.REG_STORE, program.register(self.var.name))
+
 
+@slots
 @dataclass
 class AugAssign(Assign):
     op: str
@@ -102,10 +214,21 @@ class AugAssign(Assign):
         return ast.AugAssign(assign.targets[0], op=BINOP[self.op], value=assign.value)
 
 
+@slots
 @dataclass
 class Function(Variable):
     args: List[str]
     body: Body
+    # name of the variadic argument (i.e 'bar' in func foo(bar...)), if any.
+    # This is split off from args when the node is created.
+    vararg: Optional[str] = field(init=False)
+
+    def __post_init__(self):
+        self.vararg = None
+
+        if self.args and self.args[-1].endswith("..."):
+            self.vararg = self.args[-1][:-3]
+            self.args = self.args[:-1]
 
     def compile(self):
         return ast.FunctionDef(
@@ -113,6 +236,7 @@ class Function(Variable):
             args=ast.arguments(
                 posonlyargs=[],
                 args=[ast.arg(a) for a in self.args],
+                vararg=ast.arg(self.vararg) if self.vararg else None,
                 kwonlyargs=[],
                 kw_defaults=[],
                 defaults=[],
@@ -121,7 +245,12 @@ class Function(Variable):
             decorator_list=[],
         )
 
+    def emit(self, program):
+        # the VM has no function objects, so don't fall back to loading the name.
+        Node.emit(self, program)
+
 
+@slots
 @dataclass
 class Call(Node):
     # This must be set to an empty list if there are no args.
@@ -138,6 +267,7 @@ class Call(Node):
         )
 
 
+@slots
 @dataclass
 class FunctionReturn(Node):
     expr: Any
@@ -146,27 +276,89 @@ class FunctionReturn(Node):
         return ast.Return(value=self.expr.compile())
 
 
+@slots
 @dataclass
 class UnaryOp(Node):
     op: str
     right: Any  # if the type is Any, it is an expression.
 
+    def fold(self):
+        # Evaluate the operation now if the operand is a constant, returning a Constant in place of this node.
+        # (called by the parser, so nested operations are folded bottom-up.)
+        if _is_number(self.right):
+            try:
+                return Constant(
+                    self.lineno, self.index, UNOP_FN[self.op](self.right.value)
+                )
+            except (ArithmeticError, TypeError, ValueError):
+                # leave the error to happen at runtime.
+                pass
+
+        return self
+
     def compile(self):
         return ast.UnaryOp(op=UNOP[self.op], operand=self.right.compile())
 
+    def emit(self, program):
+        self.right.emit(program)
 
+        if self.op == "!":
+            program.append(Opcode.NOT)
+        else:
+            # -x is 0 - x
+            program.append(Opcode.PUSH_CONST, 0)
+            program.append(Opcode.SUB)
+
+
+@slots
 @dataclass
 class BinaryOp(Node):
     op: str
     left: Any
     right: Any
 
+    def fold(self):
+        # Same as UnaryOp.fold, if both operands are constants.
+        if _is_number(self.left) and _is_number(self.right):
+            left, right = self.left.value, self.right.value
+
+            if type(left) is int and type(right) is int:
+                if self.op == "*":
+                    bits = left.bit_length() + right.bit_length()
+                elif self.op == "^" and right > 0:
+                    bits = left.bit_length() * right
+                else:
+                    bits = 0
+
+                if bits > MAX_FOLD_BITS:
+                    return self
+
+            try:
+                return Constant(self.lineno, self.index, BINOP_FN[self.op](left, right))
+            except (ArithmeticError, TypeError, ValueError):
+                pass
+
+        return self
+
     def compile(self):
         return ast.BinOp(
             left=self.left.compile(), op=BINOP[self.op], right=self.right.compile()
         )
 
+    def emit(self, program):
+        opcode, reverse = OPCODES[self.op]
+
+        if reverse:
+            self.left.emit(program)
+            self.right.emit(program)
+        else:
+            self.right.emit(program)
+            self.left.emit(program)
+
+        program.append(opcode)
+
 
+@slots
 @dataclass
 class Comparison(BinaryOp):
     def compile(self):
@@ -177,6 +369,7 @@ class Comparison(BinaryOp):
         )
 
 
+@slots
 @dataclass
 class Body(Node):
     decls: List[Any]
@@ -185,57 +378,71 @@ class Body(Node):
         body = []
 
         for decl in self.decls:
+            node = decl.compile()
 
-            if isinstance(decl, Comment):
-                # ignore comments
+            if node is None:
+                # pragmas don't generate any code.
                 continue
 
-            node = decl.compile()
-
-            if isinstance(node, list):
+            elif type(node) is list:
                 # some decls Must be made in the current scope (i.e C-style loops).
                 body.extend(node)
 
-            else:
+            elif type(node) in EXPRESSIONS:
                 # statement/expression
-                if isinstance(node, (ast.Call, ast.Attribute, ast.Name, ast.Constant)):
-                    # must be wrapped in an Expr object first.
-                    node = ast.Expr(value=node)
-
-                elif isinstance(decl, Import):
-                    if decl.module.name == "pragma":
-                        continue
+                # must be wrapped in an Expr object first.
+                body.append(ast.Expr(value=node))
 
+            else:
                 body.append(node)
 
         return body
 
+    def emit(self, program):
+        for decl in self.decls:
+            decl.emit(program)
+
+            if type(decl) in (Constant, Variable, UnaryOp, BinaryOp, Comparison):
+                # the value of an expression statement is unused.
+                program.append(Opcode.POP)
+
 
+@slots
 @dataclass
 class Struct(Variable):
     args: List[str]
 
     def compile(self):
+        # only needed here, so don't import it at startup.
+        import textwrap
+
         return ast.parse(
             textwrap.dedent(
                 f"""
-                {self.name} = collections.namedtuple(
+                {self.name} = dataclasses.make_dataclass(
                     "{self.name}",
-                    "{' '.join(self.args)}"
+                    {self.args!r},
+                    namespace={{"__slots__": {tuple(self.args)!r}}},
                 )
                 """
             )
         ).body[0]
 
+    def emit(self, program):
+        # same as functions: a struct definition is not a variable load.
+        Node.emit(self, program)
+
 
+@slots
 @dataclass
 class Array(Node):
     exprs: List[Any]
 
     def compile(self):
-        return ast.List(elts=[expr.compile() for expr in self.exprs], ctx=ast.Load())
+        return ast.List(elts=[expr.compile() for expr in self.exprs], ctx=LOAD)
 
 
+@slots
 @dataclass
 class Index(Node):
     target: Any
@@ -248,12 +455,13 @@ class Index(Node):
             subscript = ast.Subscript(
                 value=subscript or self.target.compile(),
                 slice=index.compile(),
-                ctx=ast.Load(),
+                ctx=LOAD,
             )
 
         return subscript
 
 
+@slots
 @dataclass
 class Conditional(Node):
     cond: Any
@@ -265,7 +473,7 @@ class Conditional(Node):
 
         root = ast.If(test=self.cond.compile(), body=self.body.compile(), orelse=[])
 
-        if self.chain is None:
+        if not self.chain:
             return root
 
         node = root
@@ -276,23 +484,119 @@ class Conditional(Node):
             if isinstance(next_node, ast.If):
                 # wrap it in a list first
                 node.orelse = [next_node]
+                node = next_node
 
             else:
+                # else (always the last in the chain)
                 node.orelse = next_node
 
-            node = next_node
+        return root
+
+    def emit(self, program):
+        # jumps at the end of each branch, to skip the rest of the chain.
+        ends = []
+
+        for branch in [self, *(self.chain or [])]:
+            if isinstance(branch, Body):
+                # else
+                branch.emit(program)
+                continue
+
+            branch.cond.emit(program)
+            skip = program.jump(Opcode.IF_FALSE)
+            branch.body.emit(program)
+
+            ends.append(program.jump(Opcode.GOTO))
+            program.patch(skip, len(program))
+
+        for end in ends:
+            program.patch(end, len(program))
+
+
+def _is_int(node):
+    return type(node) is Constant and type(node.value) is int
+
+
+def _is_number(node):
+    # bools and strings are not folded: only plain ints and floats.
+    return type(node) is Constant and type(node.value) in (int, float)
+
+
+def _is_var(node, name):
+    return type(node) is Variable and node.name == name and not node.attrs
+
+
+def _assigns(node, name):
+    # Check if a variable is assigned to anywhere under this node.
+    if isinstance(node, list):
+        return any(_assigns(n, name) for n in node)
+
+    if not isinstance(node, Node):
+        return False
+
+    if isinstance(node, Assign) and node.var.name == name:
+        return True
+
+    if isinstance(node, ForInLoop) and node.var.name == name:
+        return True
+
+    return any(_assigns(getattr(node, f.name), name) for f in fields(node))
+
+
+def _emit_loop(program, cond, body, update=None):
+    # while/for loops:
+    # start: <cond> IF_FALSE end <body> <update> GOTO start
+    # end:
+    start = len(program)
+
+    cond.emit(program)
+    exit_ = program.jump(Opcode.IF_FALSE)
+
+    continues, breaks = [], []
+    program.loops.append((continues, breaks))
+    body.emit(program)
+    program.loops.pop()
+
+    # 'continue' still has to run the update in a C-style loop.
+    for jump in continues:
+        program.patch(jump, len(program))
+
+    if update is not None:
+        update.emit(program)
+
+    program.append(Opcode.GOTO, start)
+
+    for jump in [exit_, *breaks]:
+        program.patch(jump, len(program))
 
 
 class Continue(Node):
+    __slots__ = ()
+
     def compile(self):
         return ast.Continue()
 
+    def emit(self, program):
+        if not program.loops:
+            raise CompileError(f"line {self.lineno}: 'continue' outside loop")
+
+        program.loops[-1][0].append(program.jump(Opcode.GOTO))
+
 
 class Break(Node):
+    __slots__ = ()
+
     def compile(self):
         return ast.Break()
 
+    def emit(self, program):
+        if not program.loops:
+            raise CompileError(f"line {self.lineno}: 'break' outside loop")
 
+        program.loops[-1][1].append(program.jump(Opcode.GOTO))
+
+
+@slots
 @dataclass
 class WhileLoop(Node):
     # While loop.
@@ -302,7 +606,11 @@ class WhileLoop(Node):
     def compile(self):
         return ast.While(test=self.cond.compile(), body=self.body.compile(), orelse=[])
 
+    def emit(self, program):
+        _emit_loop(program, self.cond, self.body)
+
 
+@slots
 @dataclass
 class ForLoop(Node):
     # C-style loop.
@@ -326,6 +634,10 @@ class ForLoop(Node):
         #     print(i)
         #     i += 1
 
+        counted = self._counted()
+        if counted is not None:
+            return counted
+
         body = self.body.compile()
         body.append(self.update.compile())
 
@@ -334,7 +646,73 @@ class ForLoop(Node):
             ast.While(test=self.cond.compile(), body=body, orelse=[]),
         ]
 
+    def _counted(self):
+        # Loops that count up by one between integer constants, without changing the counter in the body,
+        # are compiled to a Python for loop over a range instead (which runs in C).
+        # i.e (in Cub):
+        # for i = 0, i < 10, i += 1 {
+        #     print(i)
+        # }
+        #
+        # becomes (in Python):
+        #
+        # for i in range(0, 10):
+        #     print(i)
+        # else:
+        #     i = 10
+        var = self.assign.var
+        cond = self.cond
+        update = self.update.value
+
+        if not (
+            not var.attrs
+            and _is_int(self.assign.value)
+            and type(cond) is Comparison
+            and cond.op in ("<", "<=")
+            and _is_var(cond.left, var.name)
+            and _is_int(cond.right)
+            and self.update.var.raw() == var.name
+            and type(update) is BinaryOp
+            and update.op == "+"
+            and _is_var(update.left, var.name)
+            and _is_int(update.right)
+            and update.right.value == 1
+            and not _assigns(self.body, var.name)
+        ):
+            return None
+
+        start = self.assign.value.value
+        stop = cond.right.value + (cond.op == "<=")
+
+        body = self.body.compile() or [ast.Pass()]
+
+        return [
+            ast.For(
+                target=ast.Name(id=var.name, ctx=STORE),
+                iter=ast.Call(
+                    func=ast.Name(id="range", ctx=LOAD),
+                    args=[ast.Constant(value=start), ast.Constant(value=stop)],
+                    keywords=[],
+                ),
+                body=body,
+                # the counter's value after the loop is the same as the C-style loop.
+                # (only if the loop ran to the end; a break leaves the counter where it was.)
+                orelse=[
+                    ast.Assign(
+                        targets=[ast.Name(id=var.name, ctx=STORE)],
+                        value=ast.Constant(value=max(start, stop)),
+                    )
+                ],
+                type_comment=None,
+            ),
+        ]
+
+    def emit(self, program):
+        self.assign.emit(program)
+        _emit_loop(program, self.cond, self.body, self.update)
+
 
+@slots
 @dataclass
 class ForInLoop(Node):
     # Iterate over a string/array.
@@ -344,7 +722,7 @@ class ForInLoop(Node):
 
     def compile(self):
         target = self.var.compile()
-        target.ctx = ast.Store()
+        target.ctx = STORE
 
         return ast.For(
             target=target,
@@ -355,6 +733,7 @@ class ForInLoop(Node):
         )
 
 
+@slots
 @dataclass
 class Import(Node):
     module: Variable
@@ -1,5 +1,6 @@
 # coding: utf8
 
+from .exceptions import OxError
 from .runtime import Runtime
 from .__version__ import __version__
 
@@ -8,6 +9,8 @@ Ox {__version__}
 Type Ctrl-C/Ctrl-D to exit.
 """
 
+BRACKETS = ("()", "[]", "{}")
+
 
 class Shell:
     def __init__(self, ps1: str = "ox> ", ps2: str = "--> "):
@@ -20,7 +23,8 @@ class Shell:
         print(BANNER)
 
         code = []
-        counter = {c: 0 for c in "()[]{}"}
+        # nesting depth of (), [] and {} respectively.
+        depth = [0, 0, 0]
 
         complete = True
 
@@ -36,25 +40,19 @@ class Shell:
 
             code.append(line)
 
-            for char in line:
-                if char in counter:
-                    counter[char] += 1
+            for index, (left, right) in enumerate(BRACKETS):
+                depth[index] += line.count(left) - line.count(right)
 
-            for left, right in ("()", "[]", "{}"):
-                if counter[left] != counter[right]:
-                    complete = False
-                    break
-                else:
-                    complete = True
+            complete = not any(depth)
 
             if complete:
                 try:
                     self.runtime.execute("\n".join(code))
-                except RuntimeError as e:
+                except (OxError, RuntimeError) as e:
                     print(e)
 
                 code = []
-                counter = counter.fromkeys(counter, 0)
+                depth = [0, 0, 0]
 
     def repl(self):
         try:
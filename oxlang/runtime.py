@@ -2,24 +2,51 @@
 
 import ast
 import collections
+import dataclasses
+import functools
 import math
-import pathlib
+import os
 
 from . import syntax
 
-STDLIB_PATH = pathlib.Path(__file__).parent / "stdlib"
+# os.path is used instead of pathlib, which takes a few ms to import.
+STDLIB_PATH = os.path.join(os.path.dirname(__file__), "stdlib")
+
+# code objects for stdlib modules, shared by all runtimes so each module is only parsed once.
+_stdlib = {}
 
 
 class Runtime:
     def __init__(self):
         self.parser = syntax.Parser()
         # globals for the code to be executed.
-        self.env = {"collections": collections, "math": math}
+        self.env = {
+            "collections": collections,
+            "dataclasses": dataclasses,
+            "math": math,
+        }
+        # code objects for source that has already been compiled.
+        self._compile = functools.lru_cache(maxsize=128)(self._compile)
 
-        with (STDLIB_PATH / "lang.ox").open() as f:
-            self.execute(f.read())
+        self.load("lang.ox")
 
     def execute(self, code: str, filename: str = "<string>"):
+        exec(self._compile(code, filename), self.env)
+
+    def load(self, name: str):
+        """Execute a module from the stdlib."""
+
+        try:
+            code = _stdlib[name]
+        except KeyError:
+            path = os.path.join(STDLIB_PATH, name)
+
+            with open(path) as f:
+                code = _stdlib[name] = self._compile(f.read(), path)
+
+        exec(code, self.env)
+
+    def _compile(self, code: str, filename: str):
         tree = ast.Module(
             body=self.parser.parse_text(code, filename=filename), type_ignores=[]
         )
@@ -28,8 +55,7 @@ class Runtime:
         for node in tree.body:
             ast.increment_lineno(node)
 
-        code_obj = compile(tree, filename, mode="exec")
-        exec(code_obj, self.env)
+        return compile(tree, filename, mode="exec")
 
     def reset(self):
         self.env.clear()
@@ -4,8 +4,11 @@
 """ox's core syntax lexer and parser."""
 
 import enum
+import functools
+import operator
+import os
+import re
 import sys
-import textwrap
 
 import sly  # type: ignore
 from sly import lex, yacc
@@ -13,18 +16,20 @@ from sly import lex, yacc
 from . import model
 from .exceptions import ParserError
 
-ERROR_TEMPLATE = textwrap.dedent(
-    """
-    {filename}: In {context}:
-    {filename}:{line}:{pos}: error: {message}
-    
-    {code}
-    {indent}{arrows}
-    """
-)
+ERROR_TEMPLATE = """
+{filename}: In {context}:
+{filename}:{line}:{pos}: error: {message}
+
+{code}
+{indent}{arrows}
+"""
 
 SINGLETONS = {"true": True, "false": False, "nil": None}
 
+# Repeated rules ({ ... }) give a tuple for each repetition, so these pick out the item in them.
+_first = operator.itemgetter(0)
+_second = operator.itemgetter(1)
+
 # Pragmas change the behaviour of both the interpreter and parser.
 # Kind of like Python's 'from __future__ import ...'.
 # Pragmas have the form 'import pragma.<name>' where name is the pragma to use.
@@ -36,13 +41,15 @@ class Pragma(enum.Enum):
     CUB = 0
 
 
+# pragma name (as in 'import pragma.<name>') -> Pragma
+PRAGMAS = {pragma.name.lower(): pragma for pragma in Pragma}
+
+
 class Lexer(sly.Lexer):
 
     ignore = " \t"
 
     tokens = {
-        COMMENT,
-        LONG_COMMENT,
         ID,
         NUMBER,
         STRING,
@@ -87,9 +94,9 @@ class Lexer(sly.Lexer):
         DOT,
     }
 
-    COMMENT = r"//.*"
-    # https://stackoverflow.com/a/33312193
-    LONG_COMMENT = r"/\*[\s\S]*?\*/"
+    # Comments are skipped in tokenize(), so the parser never sees them.
+    # (?s:...) lets '.' match newlines, but only inside multi-line comments (it's faster than [\s\S]).
+    ignore_comment = r"//.*|/\*(?s:.*?)\*/"
 
     # The name can be Unicode as long as it does not start with a number.
     # Generally, variable naming follows Python (snake_case).
@@ -145,40 +152,138 @@ class Lexer(sly.Lexer):
     ELLIPSIS = r"\.\.\."
     DOT = r"\."
 
-    @_(r"\d+(\.\d+)?")
-    def NUMBER(self, t):
-        return t
+    NUMBER = r"\d+(\.\d+)?"
 
     # both single and double quoted strings are vaild
-    @_(
-        r"\"[^\"]*\"",
-        r"'[^']*'",
-    )
-    def STRING(self, t):
-        t.value = t.value[1:-1]
-        return t
+    # (the quotes are stripped in tokenize()).
+    STRING = r"\"[^\"]*\"|'[^']*'"
 
-    @_(r"\n+")
-    def ignore_newline(self, t):
-        self.lineno += len(t.value)
+    # counted in tokenize() to keep track of line numbers.
+    ignore_newline = r"\n+"
 
     def error(self, t):
         self.index += 1
         # propagate errors to the parser
         return t
 
+    def tokenize(self, text, lineno=1, index=0):
+        # Replaces sly's tokenize loop.
+        # Whitespace is skipped as part of each token's match, and keywords, strings and newlines
+        # are handled inline instead of through per-token callbacks.
+        match = _SCANNER.match
+        types = _TYPES
+        intern = sys.intern
+        ignore = self.ignore
+        length = len(text)
+
+        while index < length:
+            m = match(text, index)
+
+            if m is None:
+                while index < length and text[index] in ignore:
+                    index += 1
+
+                if index >= length:
+                    break
+
+                tok = lex.Token()
+                tok.type = "ERROR"
+                tok.value = text[index:]
+                tok.lineno = lineno
+                tok.index = index
+
+                self.index = index
+                self.lineno = lineno
+
+                tok = self.error(tok)
+                if tok is not None:
+                    tok.end = self.index
+                    yield tok
+
+                index = self.index
+                lineno = self.lineno
+                continue
+
+            group = m.lastindex
+            kind = types[group]
+            start = m.start(group)
+            index = m.end()
+
+            if kind == "newline":
+                lineno += index - start
+                continue
+
+            if kind == "comment":
+                # multi-line comments can span several lines.
+                lineno += text.count("\n", start, index)
+                continue
+
+            value = m.group(group)
+
+            if kind == "ID":
+                kind = KEYWORDS.get(value, kind)
+                # names are compared/hashed a lot, so share one string object for each name.
+                value = intern(value)
+            elif kind == "NUMBER":
+                value = float(value) if "." in value else int(value)
+            elif kind == "STRING":
+                value = value[1:-1]
+            else:
+                # operators are used as dict keys (i.e BINOP) when compiling.
+                value = intern(value)
+
+            tok = lex.Token()
+            tok.type = kind
+            tok.value = value
+            tok.lineno = lineno
+            tok.index = start
+            tok.end = index
+            yield tok
+
+            if kind == "STRING":
+                # strings can span several lines.
+                lineno += value.count("\n")
+
+        self.index = index
+        self.lineno = lineno
+
+
+# tokenize() handles every token inline and never calls sly's per-token functions (@_(...) on a token),
+# so they would be silently ignored: values have to be converted in tokenize() instead.
+assert not Lexer._token_funcs, "Lexer token functions are not supported by tokenize()"
+
+# sly's combined token regex, but also skipping any whitespace before the token.
+_SCANNER = re.compile(
+    f"[{Lexer.ignore}]*(?:{Lexer._master_re.pattern})", Lexer.reflags
+)
+
+# The token type of each group in _SCANNER, by group number (so a match's type is found from its lastindex).
+# Token types are interned, so comparing them against other interned strings is an identity check.
+_TYPES = [None] * (_SCANNER.groups + 1)
+for _name, _group in _SCANNER.groupindex.items():
+    _TYPES[_group] = sys.intern(_name)
+
+KEYWORDS = {
+    word: sys.intern(str(kind)) for word, kind in Lexer._remapping["ID"].items()
+}
+
 
 def _loc(prod):
-    try:
-        return prod.lineno, prod.index
-    except AttributeError:
-        return 0, 0
+    # The location of the first symbol in the production that has one.
+    # (sly's lineno and index properties would each scan the symbols, and raise if there are none.)
+    for sym in prod._slice:
+        if sym.lineno:
+            return sym.lineno, sym.index
+
+    return 0, 0
 
 
 class Parser(sly.Parser):
     tokens = Lexer.tokens
 
-    debugfile = "parser.out"
+    # sly writes the grammar and LALR tables here when the class is built (at import).
+    # It's a large, slow write, so only do it when debugging the grammar.
+    debugfile = "parser.out" if os.environ.get("OX_PARSER_DEBUG") else None
 
     lexer = Lexer()
 
@@ -189,7 +294,7 @@ class Parser(sly.Parser):
         ("left", EQ, LE, LT, GT, GE, NE),
         ("left", PLUS, MINUS),
         ("left", TIMES, DIVIDE),
-        ("left", POWER),
+        ("right", POWER),
     )
 
     def __init__(self):
@@ -201,19 +306,12 @@ class Parser(sly.Parser):
         # i.e function/struct name
         self.context_stack = []
 
+        # trees (and the pragmas they declared) for source that has already been parsed.
+        self._parse_code = functools.lru_cache(maxsize=128)(self._parse_code)
+
     @_("{ declaration }")
     def body(self, p):
-        decls = []
-        for decl in p[0]:
-            decl = decl[0]
-
-            if isinstance(decl, list):
-                # condition is in a nested tuple, so get rid of it
-                decls.extend([d[0] for d in decl])
-            else:
-                decls.append(decl)
-
-        return model.Body(*_loc(p), decls=decls)
+        return model.Body(*_loc(p), decls=list(map(_first, p[0])))
 
     # Not assigning the expr to a variable is valid.
     # i.e function calls: myFunc()
@@ -223,24 +321,25 @@ class Parser(sly.Parser):
         "func",
         "func_return",
         "struct",
-        "{ cond }",
+        "cond",
         "for_loop",
         "for_in_loop",
         "while_loop",
-        "CONTINUE",
-        "BREAK",
         "import_single",
         "import_multiple",
-        "comment",
     )
     def declaration(self, p):
-        if p[0] == "continue":
-            return model.Continue(*_loc(p))
-        elif p[0] == "break":
-            return model.Break(*_loc(p))
-
         return p[0]
 
+    # separate rules, so the declaration above doesn't have to compare every node against keywords.
+    @_("CONTINUE")
+    def declaration(self, p):
+        return model.Continue(*_loc(p))
+
+    @_("BREAK")
+    def declaration(self, p):
+        return model.Break(*_loc(p))
+
     @_("IMPORT id DOT LPAREN ID { COMMA ID } RPAREN")
     def import_multiple(self, p):
         # import module.submodule.(member, another_member)
@@ -248,7 +347,7 @@ class Parser(sly.Parser):
         module = p.id
         names = {}
 
-        for name in [p[4], *[i[1] for i in p[5]]]:
+        for name in [p[4], *map(_second, p[5])]:
             names[name] = None
 
         return model.Import(*_loc(p), module, names)
@@ -264,17 +363,22 @@ class Parser(sly.Parser):
         names = {}
 
         if module.name == "pragma":
-            self.pragmas.add(Pragma[module.attrs[0].upper()])
+            name = ".".join(module.attrs)
+            pragma = PRAGMAS.get(name.lower())
+
+            if pragma is None:
+                self.error(
+                    p._slice[0],
+                    f"unknown pragma '{name}' (available: {', '.join(PRAGMAS)})",
+                )
+
+            self.pragmas.add(pragma)
 
         if p[2]:
             names["*"] = None
 
         return model.Import(*_loc(p), module, names)
 
-    @_("COMMENT", "LONG_COMMENT")
-    def comment(self, p):
-        return model.Comment(*_loc(p), p[0])
-
     @_("id ASSIGN expr")
     def statement(self, p):
         return model.Assign(*_loc(p), p.id, p.expr)
@@ -284,8 +388,11 @@ class Parser(sly.Parser):
     )
     def statement(self, p):
         # statements like var += 1 are always expanded into var = var + 1
-        binop = model.BinaryOp(*_loc(p), p[1], p.id, p.expr)
-        return model.Assign(*_loc(p), p.id, binop)
+        # (the same Variable is used on both sides.)
+        loc = _loc(p)
+        var = p.id
+
+        return model.Assign(*loc, var, model.BinaryOp(*loc, p[1], var, p.expr))
 
     @_("FUNC ID new_context LPAREN [ args ] RPAREN [ RETURNS ] LBRACE body RBRACE")
     def func(self, p):
@@ -316,7 +423,7 @@ class Parser(sly.Parser):
 
     @_("ID { COMMA ID } [ ELLIPSIS ]")
     def args(self, p):
-        args = [p[0], *[a[1] for a in p[1]]]
+        args = [p[0], *map(_second, p[1])]
         if p[2][0] is not None:
             args[-1] += "..."
         return args
@@ -333,36 +440,36 @@ class Parser(sly.Parser):
     def while_loop(self, p):
         return model.WhileLoop(*_loc(p), p.expr, p.body)
 
-    @_("{ _cond }")
+    @_("if_chain", "if_chain ELSE LBRACE body RBRACE")
     def cond(self, p):
-        chain = p._cond
+        root = p.if_chain
 
-        root_cond = chain[0]
-        prev_cond = root_cond
+        if len(p) > 1:
+            # else
+            root.chain.append(p.body)
 
-        for cond in chain:
-            # attach this cond to the previous one.
-            prev_cond.orelse = cond
-            prev_cond = cond
+        return root
 
-        return root_cond
+    @_("IF expr LBRACE body RBRACE")
+    def if_chain(self, p):
+        return model.Conditional(*_loc(p), p.expr, p.body, [])
 
-    @_(
-        "IF expr LBRACE body RBRACE",
-        "ELSE IF expr LBRACE body RBRACE",
-        "ELSE LBRACE body RBRACE",
-    )
-    def _cond(self, p):
-        if len(p) > 4:
-            return model.Conditional(*_loc(p), p.expr, p.body)
-        else:
-            return p.body
+    @_("if_chain ELSE IF expr LBRACE body RBRACE")
+    def if_chain(self, p):
+        # else ifs are added to the root conditional's chain as they are parsed.
+        root = p.if_chain
+        else_ = p._slice[1]
+        root.chain.append(
+            model.Conditional(else_.lineno, else_.index, p.expr, p.body)
+        )
+
+        return root
 
     # index (i.e a[0])
     @_("expr index { index }")
     def expr(self, p):
         return model.Index(
-            *_loc(p), target=p.expr, by=[p.index0, *[i[0] for i in p[2]]]
+            *_loc(p), target=p.expr, by=[p.index0, *map(_first, p[2])]
         )
 
     @_("LBRACK expr RBRACK")
@@ -379,22 +486,39 @@ class Parser(sly.Parser):
 
     @_("expr { COMMA expr }")
     def expr_args(self, p):
-        return [p[0], *[a[1] for a in p[1]]]
+        return [p[0], *map(_second, p[1])]
 
     @_(
         "NOT expr",
         "MINUS expr",  # unary minus
     )
     def expr(self, p):
-        return model.UnaryOp(*_loc(p), p[0], p.expr)
+        return model.UnaryOp(*_loc(p), p[0], p.expr).fold()
 
-    @_("expr compare expr")
+    # The operators are spelt out in each rule (instead of going through a compare/arith rule),
+    # so sly can apply their precedence and each operation is one reduction.
+    @_(
+        "expr EQ expr",
+        "expr LE expr",
+        "expr LT expr",
+        "expr GE expr",
+        "expr GT expr",
+        "expr NE expr",
+        "expr AND expr",
+        "expr OR expr",
+    )
     def expr(self, p):
         return model.Comparison(*_loc(p), p[1], p.expr0, p.expr1)
 
-    @_("expr arith expr")
+    @_(
+        "expr PLUS expr",
+        "expr MINUS expr",
+        "expr TIMES expr",
+        "expr DIVIDE expr",
+        "expr POWER expr",
+    )
     def expr(self, p):
-        return model.BinaryOp(*_loc(p), p[1], p.expr0, p.expr1)
+        return model.BinaryOp(*_loc(p), p[1], p.expr0, p.expr1).fold()
 
     @_("STRING")
     def expr(self, p):
@@ -402,13 +526,8 @@ class Parser(sly.Parser):
 
     @_("NUMBER")
     def expr(self, p):
-        raw = p[0]
-        if "." in raw:
-            num = float(raw)
-        else:
-            num = int(raw)
-
-        return model.Constant(*_loc(p), num)
+        # converted to an int/float by the lexer.
+        return model.Constant(*_loc(p), p[0])
 
     @_("TRUE", "FALSE", "NIL")
     def expr(self, p):
@@ -424,20 +543,7 @@ class Parser(sly.Parser):
 
     @_("ID { DOT ID }")
     def id(self, p):
-        return model.Variable(*_loc(p), p[0], [a[1] for a in p[1]])
-
-    @_(
-        "EQ",
-        "LE",
-        "LT",
-        "GE",
-        "GT",
-        "NE",
-        "AND",
-        "OR",
-    )
-    def compare(self, p):
-        return p[0]
+        return model.Variable(*_loc(p), p[0], list(map(_second, p[1])))
 
     @_("PLUS", "MINUS", "TIMES", "DIVIDE", "POWER")
     def arith(self, p):
@@ -445,50 +551,83 @@ class Parser(sly.Parser):
 
     @_("")
     def new_context(self, p):
-        self.context_stack.append(f"{p[-2]} '{p[-1]}'")
+        # (kind, name), only formatted if there is an error to report.
+        self.context_stack.append((p[-2], p[-1]))
 
     def parse(self, tokens, reset=True):
         if reset:
             self.pragmas.clear()
+            # a previous parse that failed inside a block leaves its context behind.
+            self.context_stack.clear()
         return super().parse(tokens)
 
     def parse_text(self, code, filename=None):
-        self.code = code.splitlines()
+        # The code is only split into lines if there is an error to report.
+        self.code = code
 
         if filename is not None:
             self.filename = filename
 
-        tokens = self.lexer.tokenize(code)
+        tree, pragmas = self._parse_code(code)
+
+        # a cached tree skips parse(), so restore the pragmas it would have set.
+        self.pragmas.clear()
+        self.pragmas.update(pragmas)
+
+        return tree.compile()
 
-        return self.parse(self.lexer.tokenize(code)).compile()
+    def _parse_code(self, code):
+        tree = self.parse(self.lexer.tokenize(code))
+        return tree, frozenset(self.pragmas)
+
+    def _line(self, line):
+        # Get a line of the code being parsed (counting from 0).
+        if self.code is None:
+            return "(no code here)"
+
+        lines = self.code.splitlines()
+        if 0 <= line < len(lines):
+            return lines[line]
+
+        return "(no code here)"
 
     def error(self, token, msg=None, index=None, prod=None):
 
         line = 0
         pos = 0
+        arrows_len = 1
         message = msg or "Syntax error"
         code = "(no code here)"
 
-        if isinstance(token, lex.Token):
+        if token is None:
+            # the parser ran out of tokens, so point past the end of the last line.
+            message = msg or "Unexpected end of input"
+
+            if self.code is not None:
+                line = self.code.rstrip("\n").count("\n")
+                code = self._line(line)
+                pos = len(code)
+
+        elif isinstance(token, lex.Token):
             line = token.lineno - 1
             abspos = token.index
 
-            pos = abspos - sum(len(line) for line in self.code[:line])
-            pos -= line
+            if self.code is not None:
+                # the token's offset from the start of its line.
+                pos = abspos - (self.code.rfind("\n", 0, abspos) + 1)
 
-            arrows_len = len(token.value) if token.type != "ERROR" else 1
+            # the token's value may not be a string (i.e numbers), so use its span in the code instead.
+            arrows_len = token.end - abspos if token.type != "ERROR" else 1
 
-            if self.code is not None:
-                code = self.code[line]
+            code = self._line(line)
 
         elif isinstance(token, yacc.YaccSymbol):
             line = prod._slice[index - 1].lineno - 1
 
             arrows_len = len(token.value[0])
 
-            if self.code is not None:
-                code = self.code[line]
-                pos = code.find(token.value[0])
+            code = self._line(line)
+            pos = code.find(token.value[0])
 
         # pos can be -1 if the token was on the first line,
         # or the YaccSymbol value is not in the same line as the previous token.
@@ -496,9 +635,14 @@ class Parser(sly.Parser):
         if pos < 0:
             pos = 0
 
+        if self.context_stack:
+            context = "{} '{}'".format(*self.context_stack[-1])
+        else:
+            context = "<global>"
+
         message = ERROR_TEMPLATE.format(
             filename=self.filename,
-            context=self.context_stack[-1] if self.context_stack else "<global>",
+            context=context,
             line=line,
             pos=pos,
             message=message,
@@ -0,0 +1,13 @@
+# coding: utf8
+
+import pathlib
+
+import pytest
+
+curdir = pathlib.Path(__file__).parent
+
+
+@pytest.fixture(scope="session")
+def cub_files():
+    # name -> source of each Cub file, read once for all tests.
+    return {file.name: file.read_text() for file in sorted(curdir.glob("*.cub"))}
@@ -0,0 +1,197 @@
+# coding: utf8
+
+import pytest
+
+from oxlang._scorpion import Opcode, Instruction, Program, Runtime
+from oxlang.exceptions import CompileError, VMError
+from oxlang.syntax import Parser
+
+parser = Parser()
+
+
+def test_bytecode():
+    ins = Instruction(Opcode.PUSH_CONST, [b"lol", 256, 3.14, True])
+    assert ins.opcode is Opcode.PUSH_CONST
+
+
+def test_run():
+    program = Program()
+    program.append(Opcode.PUSH_CONST, 2)
+    program.append(Opcode.PUSH_CONST, 3)
+    program.append(Opcode.MUL)
+
+    rt = Runtime()
+    rt.run(program)
+
+    assert rt.stack == [6]
+
+
+def test_run_unsupported():
+    program = Program()
+    program.append(Opcode.PUSH_CONST, 1)
+    program.append(Opcode.STRUCT_INIT)
+
+    rt = Runtime()
+    with pytest.raises(VMError):
+        rt.run(program)
+
+    # nothing runs if the program can't be run to the end.
+    assert rt.stack == []
+
+
+def test_jump():
+    program = Program()
+    program.extend(
+        [
+            Instruction(Opcode.PUSH_CONST, [False]),
+            Instruction(Opcode.IF_FALSE, [3]),
+            Instruction(Opcode.PUSH_CONST, ["skipped"]),
+            Instruction(Opcode.PUSH_CONST, ["end"]),
+        ]
+    )
+
+    rt = Runtime()
+    rt.run(program)
+
+    assert rt.stack == ["end"]
+
+
+def test_optimize():
+    program = Program()
+    program.extend(
+        [
+            Instruction(Opcode.PUSH_CONST, [10]),
+            Instruction(Opcode.PUSH_CONST, [1]),
+            Instruction(Opcode.SUB, []),
+            Instruction(Opcode.PUSH_CONST, [True]),
+            Instruction(Opcode.IF_TRUE, [6]),
+            Instruction(Opcode.PUSH_CONST, ["skipped"]),
+            Instruction(Opcode.PUSH_CONST, [2]),
+            Instruction(Opcode.MUL, []),
+        ]
+    )
+
+    optimized = program.optimize()
+    assert len(optimized) < len(program)
+
+    rt = Runtime()
+    rt.run(program)
+    expected = rt.stack
+
+    rt = Runtime()
+    rt.run(optimized)
+    assert rt.stack == expected == [-18]
+
+
+def test_emit():
+    code = """
+    x = 2
+    y = (x + 3) * -x
+    z = y <= 10 && !(x > 2)
+    """
+
+    program = Program()
+    parser.parse(parser.lexer.tokenize(code)).emit(program)
+
+    rt = Runtime()
+    rt.run(program)
+
+    assert rt.stack == []
+    assert rt.registers[program.registers["y"]] == -10
+    assert rt.registers[program.registers["z"]] is True
+
+
+def test_emit_control_flow():
+    code = """
+    total = 0
+    for i = 0, i < 10, i += 1 {
+        if i == 3 {
+            continue
+        }
+        total += i
+        if i >= 6 {
+            break
+        }
+    }
+
+    n = 0
+    while n < 5 {
+        n += 2
+    }
+    """
+
+    program = Program()
+    parser.parse(parser.lexer.tokenize(code)).emit(program)
+
+    rt = Runtime()
+    rt.run(program.optimize())
+
+    assert rt.registers[program.registers["total"]] == 0 + 1 + 2 + 4 + 5 + 6
+    assert rt.registers[program.registers["n"]] == 6
+
+
+def test_optimize_registers():
+    code = """
+    x = 5
+    y = x + 1
+    z = y - x
+    w = (x * 2) * z
+    """
+
+    program = Program()
+    parser.parse(parser.lexer.tokenize(code)).emit(program)
+
+    optimized = program.optimize()
+    assert Opcode.LOAD_ADD_CONST.value in optimized.ops
+    assert Opcode.LOAD_SUB.value in optimized.ops
+
+    rt = Runtime()
+    rt.run(optimized)
+
+    assert rt.registers[program.registers["y"]] == 6
+    assert rt.registers[program.registers["z"]] == 1
+    assert rt.registers[program.registers["w"]] == 10
+
+
+def test_emit_folded():
+    program = Program()
+    parser.parse(parser.lexer.tokenize("x = 2 * 3 + -1")).emit(program)
+
+    assert list(program.ops) == [Opcode.PUSH_CONST.value, Opcode.REG_STORE.value]
+    assert program.args[0] == (5,)
+
+
+@pytest.mark.parametrize(
+    "code", ["func f() {\n    return 1\n}", "struct Point {\n    x, y\n}"]
+)
+def test_emit_unsupported(code):
+    with pytest.raises(CompileError):
+        parser.parse(parser.lexer.tokenize(code)).emit(Program())
+
+
+@pytest.mark.parametrize("code", ["break", "continue", "for x in [1] {\n    y = x\n}", "x = f(1)"])
+def test_emit_control_flow_errors(code):
+    with pytest.raises(CompileError):
+        parser.parse(parser.lexer.tokenize(code)).emit(Program())
+
+
+@pytest.mark.parametrize("opcode", [Opcode.REG_LOAD, Opcode.LOAD_ADD])
+def test_unset_register(opcode):
+    program = Program()
+    program.append(Opcode.PUSH_CONST, 1)
+    program.append(opcode, program.register("x"))
+
+    with pytest.raises(NameError):
+        Runtime().run(program)
+
+
+def test_cleared_register():
+    # None is a real value, so a cleared register must not read as None.
+    program = Program()
+    program.append(Opcode.PUSH_CONST, None)
+    program.append(Opcode.REG_STORE, program.register("x"))
+    program.append(Opcode.REG_CLEAR, program.register("x"))
+    program.append(Opcode.REG_LOAD, program.register("x"))
+
+    with pytest.raises(NameError):
+        Runtime().run(program)
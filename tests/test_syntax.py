@@ -3,31 +3,90 @@
 import ast
 import pathlib
 
-from oxlang.syntax import Lexer, Parser  # type:ignore
+import pytest
+
+from oxlang.exceptions import ParserError
+from oxlang.syntax import Lexer, Parser, Pragma  # type:ignore
 
 curdir = pathlib.Path(__file__).parent
 lexer = Lexer()
 parser = Parser()
 
 
-def test_lexer():
-    for file in curdir.glob("*.cub"):
-        tokens = lexer.tokenize(file.read_text())
+def test_lexer(cub_files):
+    for code in cub_files.values():
+        tokens = lexer.tokenize(code)
         tokens_list = list(tokens)
         # pprint.pp(tokens_list)
         assert len(tokens_list) > 0
 
 
-def test_parser():
-    for file in curdir.glob("*.cub"):
-
-        code = file.read_text()
+def test_parser(cub_files):
+    for name, code in cub_files.items():
 
-        print(f"* {file.name}")
+        print(f"* {name}")
 
-        tree = parser.parse_text(code, filename=file.name)
+        tree = parser.parse_text(code, filename=name)
         module = ast.Module(body=tree, type_ignores=[])
         ast.fix_missing_locations(module)
 
-        with (curdir / f"{file.stem}.ast").open("w") as f:
+        with (curdir / name).with_suffix(".ast").open("w") as f:
             f.write(ast.dump(module, indent=4))
+
+
+def test_error_at_end():
+    with pytest.raises(ParserError, match="Unexpected end of input"):
+        parser.parse_text("x = 1\ny = (\n")
+
+
+def test_error_context_reset():
+    with pytest.raises(ParserError):
+        parser.parse_text("func f() {\n    x = (\n")
+
+    with pytest.raises(ParserError) as e:
+        parser.parse_text("x = (\n")
+
+    assert "func 'f'" not in str(e.value)
+    assert "<global>" in str(e.value)
+
+
+def test_cached_pragmas():
+    code = "import pragma.cub\nx = 1"
+
+    parser.parse_text(code)
+    parser.parse_text("x = 1")
+    assert not parser.pragmas
+
+    parser.parse_text(code)
+    assert parser.pragmas == {Pragma.CUB}
+
+
+def test_pragma_names():
+    parser.parse_text("import pragma.CUB")
+    assert parser.pragmas == {Pragma.CUB}
+
+    with pytest.raises(ParserError, match="unknown pragma 'nope'"):
+        parser.parse_text("import pragma.nope")
+
+
+def test_precedence():
+    # constant folded, so the value shows how the expression was grouped.
+    (assign,) = parser.parse_text("x = 2 * 3 + 1 - 4")
+    assert assign.value.value == 3
+
+    # ^ groups to the right, like Python's **.
+    (assign,) = parser.parse_text("x = 2 ^ 3 ^ 2")
+    assert assign.value.value == 512
+
+
+def test_folding_limits():
+    # huge results and non-numbers are left to runtime.
+    (assign,) = parser.parse_text("x = 7 ^ 3000000")
+    assert type(assign.value) is ast.BinOp
+
+    (assign,) = parser.parse_text('x = "a" * 1000000000')
+    assert type(assign.value) is ast.BinOp
+
+    (assign,) = parser.parse_text("x = 2 ^ 10 / 0")
+    assert type(assign.value) is ast.BinOp
+    assert assign.value.left.value == 1024